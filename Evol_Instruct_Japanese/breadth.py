@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 # ==============================
 # 幅進化：問題のタイプを増やす
 # ==============================
@@ -48,8 +50,11 @@ The #Created Prompt# must be reasonable, easily understood and responded to by h
 # '#Given Prompt#'と'#Created Prompt#'、'given prompt'、'created prompt'には#Created Prompt#を含めることができない。\n"
 
 
+# 固定部分（vLLMのprefix cachingが効くよう、可変部分のinstructionより前に置く）
+breadth_header = base_instruction + "#Given Prompt#: \n "
+created_tail = " \n#Created Prompt#:\n"
+
+
+@lru_cache(maxsize=4096)
 def createBreadthPrompt(instruction):
-	prompt = base_instruction
-	prompt += "#Given Prompt#: \n {} \n".format(instruction)
-	prompt += "#Created Prompt#:\n"
-	return prompt
\ No newline at end of file
+	return breadth_header + instruction + created_tail
\ No newline at end of file
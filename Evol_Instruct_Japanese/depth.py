@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 # ==============================
 # 深さ進化：問題を少しだけ難しくする
 # ==============================
@@ -32,30 +34,29 @@ You should try not to make one sentence too long in #Rewritten Prompt#. Long sen
 # #Rewritten Prompt#が冗長にならないように努力すること。#Rewritten Prompt#は#The Given Prompt#に10語から20語程度しか追加できません。英語ではなく自然な日本語表現で書いてください。 \n\
 # '#The Given Prompt#'と'#Rewritten Prompt#'、'given prompt'、'rewritten prompt'には#Rewritten Prompt#を含めることができない。\n"
 
+# 進化方法ごとの固定部分（vLLMのprefix cachingが効くよう、可変部分のinstructionより前に置く）
+constraints_header = base_instruction.format("Please add one more constraints/requirements into #The Given Prompt#'") + "#The Given Prompt#: \n "
+deepen_header = base_instruction.format("If #The Given Prompt# contains inquiries about certain issues, the depth and breadth of the inquiry can be increased.") + "#The Given Prompt#: \n "
+concretizing_header = base_instruction.format("Please replace general concepts with more specific concepts.") + "#The Given Prompt#: \n "
+reasoning_header = base_instruction.format("If #The Given Prompt# can be solved with just a few simple thinking processes, you can rewrite it to explicitly request multiple-step reasoning.") + "#The Given Prompt#: \n "
+rewritten_tail = " \n#Rewritten Prompt#:\n"
+
+@lru_cache(maxsize=4096)
 def createConstraintsPrompt(instruction):
-	prompt = base_instruction.format("Please add one more constraints/requirements into #The Given Prompt#'")
-	prompt += "#The Given Prompt#: \n {} \n".format(instruction)
-	prompt += "#Rewritten Prompt#:\n"
-	return prompt
+	return constraints_header + instruction + rewritten_tail
 
+@lru_cache(maxsize=4096)
 def createDeepenPrompt(instruction):
-	prompt = base_instruction.format("If #The Given Prompt# contains inquiries about certain issues, the depth and breadth of the inquiry can be increased.")
-	prompt += "#The Given Prompt#: \n {} \n".format(instruction)
-	prompt += "#Rewritten Prompt#:\n"
-	return prompt
+	return deepen_header + instruction + rewritten_tail
 
+@lru_cache(maxsize=4096)
 def createConcretizingPrompt(instruction):
-	prompt = base_instruction.format("Please replace general concepts with more specific concepts.")
-	prompt += "#The Given Prompt#: \n {} \n".format(instruction)
-	prompt += "#Rewritten Prompt#:\n"
-	return prompt
+	return concretizing_header + instruction + rewritten_tail
 
 
+@lru_cache(maxsize=4096)
 def createReasoningPrompt(instruction):
-	prompt = base_instruction.format("If #The Given Prompt# can be solved with just a few simple thinking processes, you can rewrite it to explicitly request multiple-step reasoning.")
-	prompt += "#The Given Prompt#: \n {} \n".format(instruction)
-	prompt += "#Rewritten Prompt#:\n"
-	return prompt
+	return reasoning_header + instruction + rewritten_tail
 
 
 base_input_instruction = "I want you act as a Prompt Rewriter.\n \
@@ -67,8 +68,6 @@ You should try not to make one sentence too long in #Rewritten Prompt#. Long sen
 '#The Given Prompt#', '#Rewritten Prompt#', 'given prompt' and 'rewritten prompt' are not allowed to appear in #Rewritten Prompt#\n"
 
 
+@lru_cache(maxsize=4096)
 def createComplicateInputPrompt(instruction, data_format):
-	prompt = base_input_instruction.format(data_format)
-	prompt += "#The Given Prompt#: \n {} \n".format(instruction)
-	prompt += "#Rewritten Prompt#:\n"
-	return prompt
+	return base_input_instruction.format(data_format) + "#The Given Prompt#: \n " + instruction + rewritten_tail
@@ -1,3 +1,6 @@
+import string
+from functools import lru_cache
+
 # ===============================
 # Elimination Evolving. 以下の4つの状況を命令進化の失敗と分類する：
 # 1. 進化した命令が、元の命令と比べて何の情報利得ももたらさない。この判定にはChatGPTを使用する。詳細は付録Gを参照。
@@ -51,6 +54,7 @@ Your Judgement (Just answer: True or False. No need to explain the reason.):
 # Your Judgement (Just answer: True or False. No need to explain the reason. However, return True for math and programming tasks regardless of the above.):
 # """
 
+@lru_cache(maxsize=4096)
 def createEliminateComparePrompt(instruction, evol_instruction):
     prompt = eliminate_compare_prompt.format(
         first_instruction=instruction, 
@@ -71,6 +75,9 @@ def check_difficulty(response):
     """
     return "sorry" in response and len(response.split()) < 80
 
+# 句読点を削除するための変換テーブル（英語・日本語の句読点）
+punctuation_table = str.maketrans("", "", string.punctuation + "、。「」・…！？（）")
+
 def check_punctuation_stopwords(response, stop_words):
     """
     LLMが生成した応答が句読点とストップワードのみを含むかどうかを判断する関数。
@@ -78,13 +85,16 @@ def check_punctuation_stopwords(response, stop_words):
 
     Args:
     response (str): LLMから生成された応答。
-    stop_words (set): 判定に使用するストップワードのセット。
+    stop_words (frozenset): 判定に使用するストップワードのセット。punctuation_tableで句読点を削除済みのもの。
 
     Returns:
     bool: 応答が句読点とストップワードのみで構成されているかどうかの真偽値。
     """
-    words = response.split()
-    return all(word.strip('.,!?:;()[]') in stop_words or not word.strip('.,!?:;()[]') for word in words)
+    words = response.translate(punctuation_table).split()
+    return all(word in stop_words for word in words)
+
+# 進化したプロンプトからコピーされたと判断するフレーズ
+copied_phrases = ("given prompt", "rewritten prompt", "#Given Prompt#", "#Rewritten Prompt#")
 
 def check_copied_words(evol_instruction):
     """
@@ -98,9 +108,9 @@ def check_copied_words(evol_instruction):
     Returns:
     bool: 進化した命令が元の命令から単語をコピーしているかどうかの真偽値。
     """
-    copied_phrases = ["given prompt", "rewritten prompt", "#Given Prompt#", "#Rewritten Prompt#"]
     return any(phrase in evol_instruction for phrase in copied_phrases)
 
+@lru_cache(maxsize=4096)
 def createEliminateHallucinationPrompt(instruction):
     prompt = eliminate_hallucination_prompt.format(
         instruction=instruction, 
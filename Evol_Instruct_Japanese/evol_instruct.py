@@ -1,11 +1,17 @@
 import random
+import asyncio
 from tqdm.auto import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from mixtral_access import call_chatmodel, compare_evol_instructions, check_hallucination
 from depth import createConstraintsPrompt, createDeepenPrompt, createConcretizingPrompt, createReasoningPrompt, createComplicateInputPrompt
 from breadth import createBreadthPrompt
-from eliminte import createEliminateComparePrompt, createEliminateHallucinationPrompt, check_difficulty, check_punctuation_stopwords, check_copied_words
+from eliminte import createEliminateComparePrompt, createEliminateHallucinationPrompt, check_difficulty, check_punctuation_stopwords, check_copied_words, punctuation_table
+
+# mixtral_accessのクライアント・セマフォは最初に使われたイベントループに紐づくため、全世代で同じループを使い回す
+runner = asyncio.Runner()
+
+# 回答生成時の指示（vLLMのprefix cachingが効くよう、固定部分はevol_instructionより前に置く）
+answer_header = "Answer the following instruction in Japanese, not in English.\nYou must point out any uncertainties or misunderstandings in the instruction and provide as factual a response as possible.\n\n"
 
 
 def evol_instruct(all_objs, 
@@ -36,30 +42,60 @@ def evol_instruct(all_objs,
     # 進化させるリストがない時
 	if not all_objs:
 		return evol_objs, pool_objs
+
+	# ストップワードの判定は全オブジェクトで共通なので、ここで一度だけsetにする
+	# （応答側と同じく句読点を削除しておかないと、"don't"のような句読点を含むストップワードが一致しなくなる）
+	stop_words = frozenset(word.translate(punctuation_table) for word in stop_words)
 	
-	with ThreadPoolExecutor() as executor:
-		futures = [executor.submit(process_obj, obj, model, hallucination_check_model, stop_words, final_gen_flg, use_complicate_input_prompt) for obj in all_objs]
-		for future in as_completed(futures):
-			category, result = future.result()
+	async def run_all():
+		# 同じ世代内で同じInstructionへの回答は1回だけ生成して共有する
+		answer_tasks = {}
+		# 各段階で全オブジェクトのリクエストをまとめて投げ、vLLMの連続バッチングに任せる（同時実行数はmixtral_accessのセマフォで制限）
+		# 段階1: 全オブジェクトのInstructionの進化
+		evolved_objs = await asyncio.gather(*[evolve_obj(obj, model, use_complicate_input_prompt) for obj in all_objs])
+		# 段階2: 全オブジェクトの進化したInstructionのチェックと回答の生成
+		coros = [check_obj(evolved, model, hallucination_check_model, stop_words, final_gen_flg, answer_tasks) for evolved in evolved_objs]
+		for coro in asyncio.as_completed(coros):
+			category, result = await coro
 			if category == "eliminated":
 				pool_objs.append(result)
 			else:
 				evol_objs.append(result)
+
+		# 取り消したチェック・回答のタスクが次の世代に持ち越されないよう、終了まで待つ
+		leftovers = asyncio.all_tasks() - {asyncio.current_task()}
+		await asyncio.gather(*leftovers, return_exceptions=True)
+
+	runner.run(run_all())
 				
-	# all_objsのIDの順番に直す
-	evol_objs = sorted(evol_objs, key=lambda x: all_objs.index(next(obj for obj in all_objs if obj["id"] == x["id"])))
-	pool_objs = sorted(pool_objs, key=lambda x: all_objs.index(next(obj for obj in all_objs if obj["id"] == x["id"])))
+	# all_objsのIDの順番に直す（IDから位置への辞書を一度だけ作成）
+	pos = {}
+	for i, obj in enumerate(all_objs):
+		pos.setdefault(obj["id"], i)
+	evol_objs.sort(key=lambda x: pos[x["id"]])
+	pool_objs.sort(key=lambda x: pos[x["id"]])
 	
 	return evol_objs, pool_objs
 
 
-def process_obj(cur_obj, model, hallucination_check_model, stop_words, answer_flg, use_complicate_input_prompt):
+async def evolve_obj(cur_obj, model, use_complicate_input_prompt):
+    """
+    cur_objのInstructionを進化させ、check_objに渡すための辞書を返す。
+
+    Args:
+        cur_obj (dict): 進化させるInstructionを含む辞書。
+        model (str): 使用するモデルの名前。
+        use_complicate_input_prompt (bool): complicate input promptを進化方法の1つとして採用するかどうか。
+
+    Returns:
+        dict: ID、世代、進化の歴史、元のInstruction、進化したInstructionを含む辞書。
+    """
 	# ID
     origin_id = cur_obj.get("id", "")
     # 世代
     generation = cur_obj.get("generation", 0) + 1
-    # 進化の歴史
-    evol_history = cur_obj.get("evol_history", [])
+    # 進化の歴史（入力のリストを書き換えないようコピーする）
+    evol_history = list(cur_obj.get("evol_history", ()))
     
     # 幅進化の倍率(:breadth_mult)：Instructionが複雑になる前の方が幅進化が上手く行きやすい気がする
     breadth_mult = calculate_breadth_multiplier(evol_history)
@@ -72,34 +108,82 @@ def process_obj(cur_obj, model, hallucination_check_model, stop_words, answer_fl
 
     # 進化方法の選定(prompt, evol_type)
     selected_evol_prompt, selected_evol_type = select_evolution_prompt(instruction, breadth_mult, use_complicate_input_prompt)
-    evol_history += [selected_evol_type]  # 進化の歴史の更新
+    evol_history.append(selected_evol_type)  # 進化の歴史の更新
 
     # Instructionの進化
-    evol_instruction = call_chatmodel(selected_evol_prompt, model_name=model)
+    evol_instruction = await call_chatmodel(selected_evol_prompt, model_name=model)
 
     # "Translation:"以下の削除（Mixtralを使った場合、たまに入る）
     if "Translation:" in evol_instruction:
         evol_instruction = evol_instruction.split("Translation:")[0].strip()
 
-    # 進化したInstructionのチェック
+    return {"id": origin_id, "generation": generation, "evol_history": evol_history, "instruction": instruction, "evol_instruction": evol_instruction}
+
+
+async def check_obj(evolved, model, hallucination_check_model, stop_words, answer_flg, answer_tasks):
+    """
+    evolve_objで進化したInstructionをチェックし、最終世代の場合は回答を生成する。
+
+    Args:
+        evolved (dict): evolve_objの戻り値。
+        model (str): 使用するモデルの名前。
+        hallucination_check_model (str): 存在しない単語・概念等が含まれるかどうかを確認するモデルの名前。""の場合、チェックは行わない。
+        stop_words (frozenset): ストップワードのセット。
+        answer_flg (bool): 回答を生成するかどうか。
+        answer_tasks (dict): 同じ世代内で回答の生成を共有するための辞書。
+
+    Returns:
+        tuple: 結果の分類("evolved" or "eliminated")と結果の辞書のタプル。
+    """
+    origin_id = evolved["id"]
+    generation = evolved["generation"]
+    evol_history = evolved["evol_history"]
+    instruction = evolved["instruction"]
+    evol_instruction = evolved["evol_instruction"]
+
+    # 1. 進化に失敗して空の場合や元のinstructionと全く同じ場合は、LLMに確認せずに除外する
+    if not evol_instruction.strip() or evol_instruction.strip() == instruction.strip():
+        return "eliminated", {"id": origin_id, "generation": generation, "evol_history": evol_history, "instruction": evol_instruction, "output": "", "type": 1}
+
+    # 進化したInstructionのチェック（LLM）と回答の生成は互いに依存しないため、同時に投げる
     # 1. instruction, evol_instructionが同等かどうか
     check_prompt = createEliminateComparePrompt(instruction, evol_instruction)
-    if compare_evol_instructions(check_prompt, model_name=model):
+    compare_task = asyncio.create_task(compare_evol_instructions(check_prompt, model_name=model))
+    # 5. instructionに存在しない単語・概念等が含まれるかどうか（追加）
+    hallucination_task = None
+    if hallucination_check_model:
+        check_prompt = createEliminateHallucinationPrompt(evol_instruction)
+        hallucination_task = asyncio.create_task(check_hallucination(check_prompt, model_name=hallucination_check_model))
+    # 回答の生成（同じ回答プロンプトは他のオブジェクトと共有する）
+    answer_prompt = answer_header + evol_instruction
+    if answer_flg:
+        shared_answer = _acquire_answer(answer_tasks, answer_prompt, model)
+
+    def discard_pending():
+        # 除外が決まった時点で、まだ終わっていないチェックと回答を取り消す（生成途中の回答は捨てる）
+        if hallucination_task:
+            hallucination_task.cancel()
+        if answer_flg:
+            _release_answer(answer_tasks, answer_prompt)
+
+    # チェックは元の順番(1, 4, 5)で判定する
+    # 1. instruction, evol_instructionが同等かどうか
+    if await compare_task:
+        discard_pending()
         return "eliminated", {"id": origin_id, "generation": generation, "evol_history": evol_history, "instruction": evol_instruction, "output": "", "type": 1}
 
     # 4. 進化した命令が進化するプロンプトからいくつかの単語を明らかにコピーしているかどうか
     if check_copied_words(evol_instruction):
+        discard_pending()
         return "eliminated", {"id": origin_id, "generation": generation, "evol_history": evol_history, "instruction": evol_instruction, "output": "", "type": 4}
     
     # 5. instructionに存在しない単語・概念等が含まれるかどうか（追加）
-    if hallucination_check_model:
-        check_prompt = createEliminateHallucinationPrompt(evol_instruction)
-        if not check_hallucination(check_prompt, model_name=hallucination_check_model):
-            return "eliminated", {"id": origin_id, "generation": generation, "evol_history": evol_history, "instruction": evol_instruction, "output": "", "type": 5}
+    if hallucination_task and not await hallucination_task:
+        discard_pending()
+        return "eliminated", {"id": origin_id, "generation": generation, "evol_history": evol_history, "instruction": evol_instruction, "output": "", "type": 5}
     
-    # 回答の生成
     if answer_flg:
-        answer = call_chatmodel(evol_instruction+"\nYou must point out any uncertainties or misunderstandings in the instruction and provide as factual a response as possible.\nAnswer in Japanese, not in English.", model_name=model)
+        answer = await shared_answer["task"]
     else:
         # 回答の生成を行わない場合、この時点でInstructionの進化成功として返す
         return "evolved", {"id": origin_id, "generation": generation, "evol_history": evol_history, "instruction":evol_instruction, "output":""}
@@ -115,6 +199,35 @@ def process_obj(cur_obj, model, hallucination_check_model, stop_words, answer_fl
         return "evolved", {"id": origin_id, "generation": generation, "evol_history": evol_history, "instruction":evol_instruction, "output":answer}
 
 
+def _acquire_answer(answer_tasks, answer_prompt, model):
+    """
+    answer_promptへの回答を生成するタスクを取得する。同じanswer_promptのタスクが既にあればそれを共有する。
+
+    Args:
+        answer_tasks (dict): answer_promptをキー、タスクと待っているオブジェクト数を値とする辞書。
+        answer_prompt (str): 回答生成用のプロンプト。
+        model (str): 使用するモデルの名前。
+
+    Returns:
+        dict: タスク("task")と待っているオブジェクト数("waiters")の辞書。
+    """
+    shared = answer_tasks.get(answer_prompt)
+    if shared is None:
+        shared = {"task": asyncio.create_task(call_chatmodel(answer_prompt, model_name=model)), "waiters": 0}
+        answer_tasks[answer_prompt] = shared
+    shared["waiters"] += 1
+    return shared
+
+
+def _release_answer(answer_tasks, answer_prompt):
+    """回答が不要になったことを記録し、誰も待たなくなった回答の生成はキャンセルする"""
+    shared = answer_tasks[answer_prompt]
+    shared["waiters"] -= 1
+    if shared["waiters"] == 0:
+        del answer_tasks[answer_prompt]
+        shared["task"].cancel()
+
+
 def calculate_breadth_multiplier(evol_history):
     """
     evol_historyリストからbreadthの出現回数に基づいてbreadth_multを計算する。
@@ -146,18 +259,17 @@ def select_evolution_prompt(instruction, breadth_mult, use_complicate_input_prom
     Returns:
         tuple: 選ばれたpromptとevol_typeのタプル。
     """
-    evol_prompts = []
-    evol_prompts.append({"prompt": createConstraintsPrompt(instruction), "evol_type": "constraints"})
-    evol_prompts.append({"prompt": createDeepenPrompt(instruction), "evol_type": "deepen"})
-    evol_prompts.append({"prompt": createConcretizingPrompt(instruction), "evol_type": "concretizing"})
-    evol_prompts.append({"prompt": createReasoningPrompt(instruction), "evol_type": "reasoning"})
+    # 先に進化方法を重み付きで選び、選ばれた方法のpromptだけを作成する
+    evol_types = ["constraints", "deepen", "concretizing", "reasoning"]
+    weights = [1, 1, 1, 1]
     if use_complicate_input_prompt:
-        evol_prompts.append({"prompt": createComplicateInputPrompt(instruction, _select_input_data()), "evol_type": "complicate_input"})
-    for _ in range(breadth_mult):
-        evol_prompts.append({"prompt": createBreadthPrompt(instruction), "evol_type": "breadth"})
+        evol_types.append("complicate_input")
+        weights.append(1)
+    evol_types.append("breadth")
+    weights.append(breadth_mult)
 
-    selected = random.choice(evol_prompts)
-    return selected["prompt"], selected["evol_type"]
+    evol_type = random.choices(evol_types, weights=weights)[0]
+    return evol_prompt_builders[evol_type](instruction), evol_type
 
 
 def _select_input_data():
@@ -170,3 +282,14 @@ def _select_input_data():
         "JSON data"
     ]
     return random.choice(data_formats)
+
+
+# 進化方法(evol_type)ごとのprompt作成関数
+evol_prompt_builders = {
+    "constraints": createConstraintsPrompt,
+    "deepen": createDeepenPrompt,
+    "concretizing": createConcretizingPrompt,
+    "reasoning": createReasoningPrompt,
+    "complicate_input": lambda instruction: createComplicateInputPrompt(instruction, _select_input_data()),
+    "breadth": createBreadthPrompt,
+}
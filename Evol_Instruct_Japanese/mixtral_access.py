@@ -1,25 +1,96 @@
-import requests
-from openai import OpenAI, OpenAIError
-import time
+import os
+import random
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS, OpenAIError, APIConnectionError, APITimeoutError, RateLimitError, InternalServerError
+import asyncio
+import hashlib
 import json
+from collections import OrderedDict
+import httpx
 
 
 # with open('config/secret_config.json') as f:
     # config = json.load(f)
 
+# サーバーごとに同時に投げるリクエスト数の上限。vLLMサーバーの--max-num-seqsと同じ値にする
+# （大きすぎるとvLLM側でpreemptionが起きて遅くなり、小さすぎるとバッチが埋まらない）
+MAX_CONCURRENCY = int(os.environ.get("EVOL_CONCURRENCY", 256))
+
+# vLLMサーバーのURL。両方に同じURLを指定した場合、1つのサーバーにmodel名で振り分ける
+BASE_URL = os.environ.get("EVOL_BASE_URL", "http://localhost:8001/v1")
+CHECK_BASE_URL = os.environ.get("EVOL_CHECK_BASE_URL", "http://localhost:8002/v1")
+
+
+def _create_http_client():
+    """
+    同時リクエスト数に合わせたコネクションプールを持つHTTPクライアントを作成する。
+    openaiのデフォルト（最大1000接続、keep-aliveは100接続まで、接続タイムアウト5秒）を元に、
+    同時リクエスト数がそれを超える場合のみ上限を引き上げる。
+    """
+    return DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=max(MAX_CONCURRENCY, DEFAULT_CONNECTION_LIMITS.max_connections),
+            max_keepalive_connections=max(MAX_CONCURRENCY, DEFAULT_CONNECTION_LIMITS.max_keepalive_connections),
+            keepalive_expiry=DEFAULT_CONNECTION_LIMITS.keepalive_expiry,
+        ),
+    )
+
+
 # vLLM用に変更
-openai = OpenAI(
-    api_key="test",
-    base_url="http://localhost:8001/v1",
-)
-# hallucination_check_model用にもう1つ作成
-openai_2 = OpenAI(
+openai = AsyncOpenAI(
     api_key="test",
-    base_url="http://localhost:8002/v1",
+    base_url=BASE_URL,
+    http_client=_create_http_client(),
+    max_retries=0,  # リトライはcall_chatmodel等のループだけで行う（SDK側のリトライと重ならないようにする）
 )
+semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+# hallucination_check_model用にもう1つ作成（同じサーバーの場合はクライアントと同時リクエスト数の上限を共有する）
+if CHECK_BASE_URL == BASE_URL:
+    openai_2 = openai
+    semaphore_2 = semaphore
+else:
+    openai_2 = AsyncOpenAI(
+        api_key="test",
+        base_url=CHECK_BASE_URL,
+        http_client=_create_http_client(),
+        max_retries=0,
+    )
+    semaphore_2 = asyncio.Semaphore(MAX_CONCURRENCY)
+
+# 全リクエストの先頭に付く固定文言（vLLMの--enable-prefix-cachingでKVキャッシュを再利用できるよう、可変部分は必ずこの後ろに付ける）
+system_prompt = "You are a helpful Japanese assistant.\n"
+
+# チェック結果のキャッシュ（同じプロンプトのチェックはリクエストを投げずに結果を返す）
+# プロセス全体で使い回すため、CHECK_CACHE_SIZE件を超えたら最も古く使われた結果から捨てる
+CHECK_CACHE_SIZE = 100_000
+check_cache = OrderedDict()
+# 実行中のチェックのタスクと待っている呼び出し数（同じプロンプトのチェックが同時に来た場合は1つのリクエストを共有する）
+pending_checks = {}
 
+# チェックの回答をvLLMのguided decodingでどちらかの文字列に制限する（不明な回答による再確認をなくす）
+compare_choices = ["Equal", "Not Equal"]
+hallucination_choices = ["True", "False"]
+# guided_choiceで回答は必ずどちらかになるため、チェックのリトライは接続エラー等の場合に1回だけ行う
+CHECK_ATTEMPTS = 2
 
-def get_oai_completion(
+
+def _cache_key(model, prompt, **params):
+    """model, prompt, サンプリングパラメータからキャッシュのキーを作成する"""
+    # チェックのたびに呼ばれるため、JSONにシリアライズせず区切り文字で連結してハッシュを取る
+    raw = "\0".join([model, prompt, repr(sorted(params.items()))])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# リトライで回復する見込みのあるエラー（接続エラー・タイムアウト・レートリミット・5xx）
+# それ以外のOpenAIError（プロンプトが長すぎる等）はリトライしても成功しない
+RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+
+async def _backoff(attempt):
+    """attempt回目の失敗後、指数バックオフ（+ジッター）で待機する"""
+    await asyncio.sleep(2 ** attempt + random.random())
+
+
+async def get_oai_completion(
         prompt, 
         model="mistralai/Mixtral-8x22B-Instruct-v0.1",
         temperature=0.9,
@@ -28,38 +99,27 @@ def get_oai_completion(
         stop=None,
         n=1,
         mode="create",
+        extra_body=None,
     ):
 
+    # prompt rewritingの場合（Mixtral-8x22B-Instructを使う場合）はopenai、hallucination checkの場合（Mixtral-8x7B-Instructを使う場合）はopenai_2
+    client, client_semaphore = (openai, semaphore) if mode == "create" else (openai_2, semaphore_2)
     try: 
-        # prompt rewritingの場合（Mixtral-8x22B-Instructを使う場合）
-        if mode == "create":
-            response = openai.chat.completions.create(
+        async with client_semaphore:
+            response = await client.chat.completions.create(
                 model=model,
                 messages=[
                     # Mixtralの純正chat templateはsystem messageを許可しないのでuser messageに文言を追加するよう修正
-                        {"role": "user", "content": "You are a helpful Japanese assistant.\n" + prompt},
+                        {"role": "user", "content": system_prompt + prompt},
                     ],
                 temperature=temperature,
                 max_tokens=max_tokens,
                 top_p=top_p,
                 stop=stop,
+                extra_body=extra_body,
             )
-            return response.choices[0].message.content
-        # hallucination checkの場合（Mixtral-8x7B-Instructを使う場合）
-        else:
-            response = openai_2.chat.completions.create(
-                model=model,
-                messages=[
-                    # Mixtralの純正chat templateはsystem messageを許可しないのでuser messageに文言を追加するよう修正
-                        {"role": "user", "content": "You are a helpful Japanese assistant.\n" + prompt},
-                    ],
-                temperature=temperature,
-                max_tokens=max_tokens,
-                top_p=top_p,
-                stop=stop,
-            )
-            return response.choices[0].message.content
-    except requests.exceptions.Timeout as e:
+        return response.choices[0].message.content
+    except APITimeoutError as e:
         # Handle the timeout error here
         print("The API request timed out. Please try again later.")
         raise e
@@ -68,28 +128,29 @@ def get_oai_completion(
         raise e
 
 
-def call_chatmodel(instruction, model_name="mistralai/Mixtral-8x22B-Instruct-v0.1"):
-    success = False
+async def call_chatmodel(instruction, model_name="mistralai/Mixtral-8x22B-Instruct-v0.1"):
     re_try_count = 5
-    ans = ''
-    while not success and re_try_count >= 0:
-        re_try_count -= 1
+    for attempt in range(re_try_count + 1):
         try:
-            ans = get_oai_completion(
+            return await get_oai_completion(
                 instruction, 
                 model=model_name,
                 temperature=0.8,
                 top_p=0.95,
                 mode="create",
             )
-            success = True
-        except:
-            time.sleep(2)
+        except RETRYABLE_ERRORS:
+            if attempt == re_try_count:
+                break
+            await _backoff(attempt)
             print('retry for sample:', instruction)
-    return ans
+        except OpenAIError:
+            # リトライしても成功しないエラーの場合、リトライせずに空文字を返す
+            break
+    return ''
 
 
-def compare_evol_instructions(prompt, model_name="mistralai/Mixtral-8x22B-Instruct-v0.1"):
+async def compare_evol_instructions(prompt, model_name="mistralai/Mixtral-8x22B-Instruct-v0.1"):
     """
     データに対してチェックを行い、結果をbool値で返す。
 
@@ -99,14 +160,20 @@ def compare_evol_instructions(prompt, model_name="mistralai/Mixtral-8x22B-Instru
     Returns:
     bool: チェックの結果(Equal: True, Not Equal: False)
     """
-    # 最大5回確認
-    for _ in range(5):
+    key = _cache_key(model_name, prompt, max_tokens=4, mode="create", guided_choice=compare_choices)
+    return await _shared_check(key, lambda: _ask_compare(prompt, model_name))
+
+
+async def _ask_compare(prompt, model_name):
+    """compare_evol_instructionsのリクエスト部分。結果が不明な場合はNoneを返す"""
+    for attempt in range(CHECK_ATTEMPTS):
         try:
-            check_result = get_oai_completion(
+            check_result = await get_oai_completion(
                 prompt, 
                 model=model_name,
-                max_tokens=3,
+                max_tokens=4,
                 mode="create", # ここはhallucination_check_modelではなく通常のmodelを使う実装の模様
+                extra_body={"guided_choice": compare_choices},
             )
             # print(f"check_result: {check_result}")
             # resultを返す(TrueとFalseのどちらか)
@@ -115,15 +182,18 @@ def compare_evol_instructions(prompt, model_name="mistralai/Mixtral-8x22B-Instru
             elif "Equal" in check_result:
                 return True
             else:
-                continue
-        except Exception as e:
+                return None
+        except RETRYABLE_ERRORS as e:
             print(f"Error: {e}")
-        time.sleep(2)  # リクエストレートリミットのために一時停止
-    # 最大数確認しても結果が不明な場合、Falseとする
-    return False
+            if attempt + 1 < CHECK_ATTEMPTS:
+                await _backoff(attempt)
+        except OpenAIError:
+            # リトライしても成功しないエラーの場合、確認を打ち切る
+            break
+    return None
     
 
-def check_hallucination(prompt, model_name="mistralai/Mixtral-8x7B-Instruct-v0.1"):
+async def check_hallucination(prompt, model_name="mistralai/Mixtral-8x7B-Instruct-v0.1"):
     """
     データに対してチェックを行い、結果をbool値で返す。
 
@@ -133,14 +203,20 @@ def check_hallucination(prompt, model_name="mistralai/Mixtral-8x7B-Instruct-v0.1
     Returns:
     bool: チェックの結果(ハルシネーションなし: True, ハルシネーションあり: False)
     """
-    # 最大5回確認
-    for _ in range(5):
+    key = _cache_key(model_name, prompt, max_tokens=4, mode="check", guided_choice=hallucination_choices)
+    return await _shared_check(key, lambda: _ask_hallucination(prompt, model_name))
+
+
+async def _ask_hallucination(prompt, model_name):
+    """check_hallucinationのリクエスト部分。結果が不明な場合はNoneを返す"""
+    for attempt in range(CHECK_ATTEMPTS):
         try:
-            check_result = get_oai_completion(
+            check_result = await get_oai_completion(
                 prompt, 
                 model=model_name,
-                max_tokens=3,
+                max_tokens=4,
                 mode="check", # hallucination_check_modelを使う
+                extra_body={"guided_choice": hallucination_choices},
                 # temperature=1.0,
                 # top_p=0.95,
             )
@@ -153,9 +229,59 @@ def check_hallucination(prompt, model_name="mistralai/Mixtral-8x7B-Instruct-v0.1
             elif "True" in check_result and "False" not in check_result:
                 return True
             else:
-                continue
-        except Exception as e:
+                return None
+        except RETRYABLE_ERRORS as e:
             print(f"Error: {e}")
-        time.sleep(2)  # リクエストレートリミットのために一時停止
-    # 最大数確認しても結果が不明な場合、Falseとする
-    return False
\ No newline at end of file
+            if attempt + 1 < CHECK_ATTEMPTS:
+                await _backoff(attempt)
+        except OpenAIError:
+            # リトライしても成功しないエラーの場合、確認を打ち切る
+            break
+    return None
+
+
+async def _shared_check(key, ask):
+    """
+    同じキーのチェックは1回だけリクエストし、結果を共有する。
+    結果が確定したものはcheck_cacheから返し、実行中のものはpending_checksのタスクの結果を待つ。
+
+    Args:
+    key (str): _cache_keyで作成したキー
+    ask (callable): チェックのリクエストを行うコルーチンを返す関数
+
+    Returns:
+    bool: チェックの結果(最大数確認しても結果が不明な場合、False)
+    """
+    if key in check_cache:
+        check_cache.move_to_end(key)
+        return check_cache[key]
+    shared = pending_checks.get(key)
+    if shared is None:
+        shared = {"task": asyncio.ensure_future(ask()), "waiters": 0}
+        pending_checks[key] = shared
+        shared["task"].add_done_callback(lambda t: _finish_check(key, t))
+    shared["waiters"] += 1
+    try:
+        # 待っている側がキャンセルされても、同じチェックを待つ他の呼び出しがいる間はリクエストを続ける
+        result = await asyncio.shield(shared["task"])
+    except asyncio.CancelledError:
+        # 誰も待たなくなったチェックはリクエストごとキャンセルする
+        shared["waiters"] -= 1
+        if shared["waiters"] == 0:
+            if pending_checks.get(key) is shared:
+                del pending_checks[key]
+            shared["task"].cancel()
+        raise
+    shared["waiters"] -= 1
+    return False if result is None else result
+
+
+def _finish_check(key, task):
+    """チェックのタスク完了時に、確定した結果をcheck_cacheに保存する"""
+    shared = pending_checks.get(key)
+    if shared is not None and shared["task"] is task:
+        del pending_checks[key]
+    if not task.cancelled() and task.exception() is None and task.result() is not None:
+        check_cache[key] = task.result()
+        if len(check_cache) > CHECK_CACHE_SIZE:
+            check_cache.popitem(last=False)